@@ -1,6 +1,9 @@
-from flask import Flask, render_template, send_from_directory, request, redirect, url_for, flash, jsonify
+from flask import Flask, render_template, send_from_directory, request, redirect, url_for, flash, jsonify, abort, make_response
+from werkzeug.security import safe_join
+from inotify_simple import INotify, flags
 from datetime import datetime
-import os, csv, locale, shutil, secrets 
+import polars as pl
+import os, locale, shutil, secrets, time, threading, functools
 
 locale.setlocale(locale.LC_TIME, 'fr_FR.UTF-8')
 
@@ -8,7 +11,14 @@ app = Flask(__name__)
 app.secret_key = secrets.token_hex(16)
 
 VIDEO_DIR = "videos"
+VIDEO_BASE = os.path.realpath(VIDEO_DIR)
 LOG_FILE = "logs/detections.csv"
+STATUS_RECORDING_FILE = "/home/slaur/Documents/Birdwatcher/recording.flag"
+RECORDING_STATUS_TTL = 0.5  # secondes
+# Préfixe interne nginx pour servir les vidéos via X-Accel-Redirect (None = Flask les sert).
+# Côté nginx :
+#   location /internal_videos/ { internal; alias /home/slaur/Documents/Birdwatcher/videos/; }
+X_ACCEL_PREFIX = None  # ex. "/internal_videos/"
 LABEL_TRANSLATIONS = {
     "person": "Personne",
     "bird": "Oiseau"
@@ -18,51 +28,179 @@ def get_free_space_mb(path="/"):
     total, used, free = shutil.disk_usage(path)
     return free // (1024 * 1024)  # en Mo
 
+_recording_state = {"val": False, "ts": 0.0}
+
 def is_recording():
-    return os.path.exists("/home/slaur/Documents/Birdwatcher/recording.flag")
+    # /status est interrogé en boucle : on ne revérifie le fichier témoin
+    # qu'au plus une fois par RECORDING_STATUS_TTL.
+    now = time.monotonic()
+    if now - _recording_state["ts"] >= RECORDING_STATUS_TTL:
+        _recording_state["val"] = os.path.exists(STATUS_RECORDING_FILE)
+        _recording_state["ts"] = now
+    return _recording_state["val"]
 
-@app.route('/')
-def index():
-    dates = sorted(os.listdir(VIDEO_DIR), reverse=True)
+# === Cache de l'arborescence des vidéos, invalidé par inotify ===
+WATCH_FLAGS = flags.CREATE | flags.DELETE | flags.MOVED_TO | flags.MOVED_FROM
+_dir_lock = threading.Lock()
+# "watching" reste faux tant que la surveillance n'est pas en place, ou si
+# elle s'est arrêtée : list_videos() rescanne alors à chaque requête.
+_dir_cache = {"gen": 0, "videos": None, "watching": False}
+
+def _invalidate_dir_cache():
+    with _dir_lock:
+        _dir_cache["gen"] += 1
+        _dir_cache["videos"] = None
+
+def _add_watch(inotify, path):
+    try:
+        inotify.add_watch(path, WATCH_FLAGS)
+    except FileNotFoundError:
+        pass  # Dossier supprimé entre-temps : rien à surveiller
+
+def _run_watcher():
+    inotify = INotify()
+    root_wd = inotify.add_watch(VIDEO_DIR, WATCH_FLAGS)
+    with os.scandir(VIDEO_DIR) as it:
+        for entry in it:
+            if entry.is_dir():
+                _add_watch(inotify, entry.path)
+    # Un scan a pu avoir lieu avant que les surveillances soient en place
+    with _dir_lock:
+        _dir_cache["watching"] = True
+    _invalidate_dir_cache()
+    while True:
+        for event in inotify.read():
+            if event.wd == root_wd and event.mask & flags.ISDIR \
+                    and event.mask & (flags.CREATE | flags.MOVED_TO):
+                # Nouveau dossier daté : on le surveille avant de rescanner
+                _add_watch(inotify, os.path.join(VIDEO_DIR, event.name))
+        _invalidate_dir_cache()
+
+def _watch_videos():
+    try:
+        _run_watcher()
+    except Exception:
+        # ex. limite de surveillances inotify atteinte (ENOSPC)
+        app.logger.exception("Surveillance de %s arrêtée, scan à chaque requête", VIDEO_DIR)
+        with _dir_lock:
+            _dir_cache["watching"] = False
+            _dir_cache["videos"] = None
+
+def _scan_videos():
     videos_by_date = {}
+    with os.scandir(VIDEO_DIR) as it:
+        dates = sorted((e for e in it if e.is_dir()), key=lambda e: e.name, reverse=True)
+    for entry in dates:
+        try:
+            with os.scandir(entry.path) as it:
+                videos_by_date[entry.name] = sorted(
+                    (f.name for f in it if f.name.endswith(".mp4") and f.is_file()), reverse=True)
+        except FileNotFoundError:
+            continue  # Dossier supprimé pendant le scan
+    return videos_by_date
+
+def list_videos():
+    with _dir_lock:
+        if not _dir_cache["watching"]:
+            gen = None
+        elif _dir_cache["videos"] is not None:
+            return _dir_cache["videos"]
+        else:
+            gen = _dir_cache["gen"]
+    videos_by_date = _scan_videos()
+    with _dir_lock:
+        # On ne mémorise pas un scan rendu obsolète par un événement concurrent
+        if gen is not None and _dir_cache["watching"] and _dir_cache["gen"] == gen:
+            _dir_cache["videos"] = videos_by_date
+    return videos_by_date
+
+def _mtime(path):
+    try:
+        return os.stat(path).st_mtime_ns
+    except FileNotFoundError:
+        return 0
+
+# === Données de la page, reconstruites seulement si les vidéos ou le journal changent ===
+_payload = {"gen": None, "mtime_l": None, "data": None}
+
+def _get_payload():
+    global _payload
+    gen = _dir_cache["gen"]
+    mtime_l = _mtime(LOG_FILE)
+    payload = _payload
+    if payload["data"] is None or not _dir_cache["watching"] \
+            or payload["gen"] != gen or payload["mtime_l"] != mtime_l:
+        # Remplacement d'un seul bloc : une requête concurrente voit l'ancien
+        # ou le nouveau contenu, jamais un mélange des deux
+        payload = {"gen": gen, "mtime_l": mtime_l, "data": _build_library()}
+        _payload = payload
+    return payload
+
+@functools.lru_cache(maxsize=4096)
+def _format_ts(s):
+    # Format fixe AAAA-MM-JJ_HH-MM-SS : découpage direct, sans strptime
+    timestamp = datetime(int(s[0:4]), int(s[5:7]), int(s[8:10]),
+                         int(s[11:13]), int(s[14:16]), int(s[17:19]))
+    return timestamp.strftime("%d %B %Y à %Hh%M")
+
+LOG_COLUMNS = ["timestamp", "label", "confidence", "video_path"]
+
+def load_detections():
+    # Index des détections par chemin de vidéo (première entrée conservée),
+    # lecture et dédoublonnage faits par polars ; confiance déjà en pourcentage.
+    if not os.path.exists(LOG_FILE) or os.path.getsize(LOG_FILE) == 0:
+        return {}
+    # Colonnes lues par position et en texte : l'en-tête peut manquer, et une
+    # ligne abîmée est écartée seule sans rendre la page indisponible
+    try:
+        df = pl.read_csv(LOG_FILE, has_header=False, truncate_ragged_lines=True,
+                         schema={name: pl.Utf8 for name in LOG_COLUMNS})
+    except pl.exceptions.PolarsError as e:
+        app.logger.warning("Journal des détections illisible : %s", e)
+        return {}
+    df = (
+        df.filter(pl.col("timestamp") != "timestamp")  # ligne d'en-tête
+        .with_columns(pl.col("confidence").cast(pl.Float64, strict=False))
+        .filter(pl.col("video_path").is_not_null() & pl.col("confidence").is_not_null())
+        .unique(subset=["video_path"], keep="first", maintain_order=True)
+        .with_columns(pl.col("label").fill_null(""), pl.col("confidence") * 100)
+    )
+    return {r["video_path"]: r for r in df.iter_rows(named=True)}
+
+def _build_library():
+    videos_by_date = list_videos()
     video_logs = {}
-    
+
+    log_index = load_detections()
+
+    for date, files in videos_by_date.items():
+        for file in files:
+            full_path = f"videos/{date}/{file}"
+            raw = log_index.get(full_path)
+            if raw:
+                # Reformater les champs
+                formatted_date = _format_ts(raw["timestamp"])
+                label = LABEL_TRANSLATIONS.get(raw["label"], raw["label"].capitalize())
+                confidence = f"{raw['confidence']:.1f} %"
+                video_logs[file] = {
+                    "date": formatted_date,
+                    "label": label,
+                    "confidence": confidence
+                }
+
+    return {"videos_by_date": videos_by_date, "video_logs": video_logs}
+
+@app.route('/')
+def index():
+    # Seule la liste des vidéos est mise en cache : l'espace disque et
+    # l'état d'enregistrement restent évalués à chaque requête.
+    payload = _get_payload()
+
     free_space_mb = get_free_space_mb()
     low_disk_space = free_space_mb < 100
 
-    log_entries = []
-    if os.path.exists(LOG_FILE):
-        with open(LOG_FILE, newline='') as f:
-            reader = csv.reader(f)
-            all_rows = list(reader)
-            headers = all_rows[0]
-            log_entries = all_rows[1:]
-
-    for date in dates:
-        path = os.path.join(VIDEO_DIR, date)
-        if os.path.isdir(path):
-            files = sorted(os.listdir(path), reverse=True)
-            videos_by_date[date] = files
-            for file in files:
-                if file.endswith(".mp4"):
-                    full_path = f"videos/{date}/{file}"
-                    logs = [entry for entry in log_entries if entry[3] == full_path]
-                    if logs:
-                        raw = logs[0]
-                        # Reformater les champs
-                        timestamp = datetime.strptime(raw[0], "%Y-%m-%d_%H-%M-%S")
-                        formatted_date = timestamp.strftime("%d %B %Y à %Hh%M")
-                        label = LABEL_TRANSLATIONS.get(raw[1], raw[1].capitalize())
-                        confidence = f"{float(raw[2]) * 100:.1f} %"
-                        video_logs[file] = {
-                            "date": formatted_date,
-                            "label": label,
-                            "confidence": confidence
-                        }
-                        
     return render_template("index.html", 
-                           videos_by_date=videos_by_date, 
-                           video_logs=video_logs, 
+                           **payload["data"],
                            low_disk_space=low_disk_space, 
                            free_space_mb=free_space_mb, 
                            is_recording=is_recording()
@@ -70,12 +208,30 @@ def index():
 
 @app.route('/videos/<date>/<filename>')
 def serve_video(date, filename):
+    if X_ACCEL_PREFIX:
+        # nginx envoie le fichier lui-même (sendfile), le worker Flask est libéré
+        internal_path = safe_join(X_ACCEL_PREFIX, date, filename)
+        if internal_path is None:
+            abort(404)
+        response = make_response("")
+        response.headers["X-Accel-Redirect"] = internal_path
+        response.headers["Content-Type"] = "video/mp4"
+        return response
     return send_from_directory(os.path.join(VIDEO_DIR, date), filename)
 
 @app.route("/delete", methods=["POST"])
 def delete_video():
     video_rel_path = request.form.get("video_path")
-    video_abs_path = os.path.join(VIDEO_DIR, video_rel_path)
+    if not video_rel_path:
+        abort(400)
+    # Refuse tout chemin qui sortirait du dossier des vidéos (../, liens...)
+    try:
+        video_abs_path = os.path.realpath(os.path.join(VIDEO_BASE, video_rel_path))
+        inside = os.path.commonpath([video_abs_path, VIDEO_BASE]) == VIDEO_BASE
+    except ValueError:  # ex. octet nul dans le chemin
+        abort(400)
+    if not inside:
+        abort(403)
 
     try:
         if os.path.exists(video_abs_path):
@@ -93,5 +249,8 @@ def status():
     is_recording_status = is_recording()
     return jsonify({"is_recording": is_recording_status})
 
+os.makedirs(VIDEO_DIR, exist_ok=True)
+threading.Thread(target=_watch_videos, daemon=True).start()
+
 if __name__ == '__main__':
     app.run(host='0.0.0.0', port=5000)
@@ -1,8 +1,9 @@
 import RPi.GPIO as GPIO
-import time, cv2, csv, os, subprocess
+import time, cv2, csv, os, threading, queue
 from picamera2 import Picamera2
 from datetime import datetime
 from picamera2.encoders import H264Encoder
+from picamera2.outputs import PyavOutput
 from ultralytics import YOLO
 import numpy as np
 
@@ -10,15 +11,34 @@ import numpy as np
 PIR_GPIO = 14
 IR_CUT_GPIO = 18
 VIDEO_DIR = "videos"
+FRAME_SIZE = (1280, 720)  # Résolution de capture (largeur, hauteur)
+LOG_PATH = "logs/detections.csv"
 MAX_DURATION = 45  # Durée maximale de chaque enregistrement
 NO_PRESENCE_TIMEOUT = 6  # Durée sans détection avant arrêt
+RECORD_LOOP_PERIOD = 0.05  # Cadence de la boucle d'enregistrement (secondes)
 TARGET_CLASSES = ["person", "bird"]  # Classes à surveiller
 STATUS_RECORDING_FILE = "/home/slaur/Documents/Birdwatcher/recording.flag"
+MODEL_FILE = "yolov8n.pt"
+NCNN_MODEL_DIR = "yolov8n_ncnn_model"  # Modèle exporté pour NCNN (FP16, ARM NEON)
+DETECT_SIZE = 320  # Taille d'entrée du modèle exporté
+MOTION_THRESHOLD = 2.0  # Écart moyen (niveaux de gris) en dessous duquel l'image est jugée inchangée
+FORCE_DETECT_INTERVAL = 2  # Délai max (secondes) entre deux analyses IA pendant un enregistrement
 
 # === Variables globales ===
-last_check = 0
+last_check = float("-inf")  # Horloge monotone, première vérification immédiate
 check_interval = 10  # secondes
 is_night_mode = False
+_CLAHE = cv2.createCLAHE(clipLimit=2.0, tileGridSize=(8,8))  # Réutilisé à chaque image de nuit
+_gray_buf = np.empty((FRAME_SIZE[1], FRAME_SIZE[0]), dtype=np.uint8)  # Tampon de conversion en niveaux de gris
+_active_recording = None  # Chemin final du clip en cours, None hors enregistrement
+_prev_gray = None  # Miniature de la dernière image envoyée à YOLO
+_last_detect_time = float("-inf")  # Instant (monotone) de la dernière image envoyée à YOLO
+
+# === File d'analyse IA en arrière-plan (seule l'image la plus récente est gardée) ===
+frame_q = queue.Queue(maxsize=1)
+result = {"label": None}
+_result_lock = threading.Lock()
+_model_lock = threading.Lock()
 
 # === Création des répertoires nécessaires ===
 os.makedirs(VIDEO_DIR, exist_ok=True)
@@ -28,39 +48,86 @@ os.makedirs(daily_video_dir, exist_ok=True)
 
 os.makedirs("logs", exist_ok=True)
 
+# === Journal des détections, ouvert une seule fois (tampon ligne par ligne) ===
+_log_f = open(LOG_PATH, "a", newline="", buffering=1)
+_log_writer = csv.writer(_log_f)
+_header_written = os.path.getsize(LOG_PATH) > 0
+
+# === Chargement du modèle IA YOLOv8 léger ===
+# Export unique vers NCNN en demi-précision, bien plus rapide que PyTorch sur le Pi.
+# Le dossier est créé dès le début de l'export : seul metadata.yaml, écrit en
+# dernier, garantit qu'un export interrompu ne sera pas chargé.
+if not os.path.isfile(os.path.join(NCNN_MODEL_DIR, "metadata.yaml")):
+    YOLO(MODEL_FILE).export(format="ncnn", half=True, imgsz=DETECT_SIZE)
+model = YOLO(NCNN_MODEL_DIR)
+
 # === Initialisation des broches GPIO ===
 GPIO.setmode(GPIO.BCM)
 GPIO.setup(PIR_GPIO, GPIO.IN, pull_up_down=GPIO.PUD_DOWN)
 GPIO.setup(IR_CUT_GPIO, GPIO.OUT)
 
+# Le noyau signale les fronts montants du PIR : plus besoin de scruter la broche.
+# Certaines combinaisons noyau / RPi.GPIO refusent la détection de fronts :
+# on revient alors à la lecture de la broche toutes les 100 ms.
+pir_event = threading.Event()
+try:
+    GPIO.add_event_detect(PIR_GPIO, GPIO.RISING, callback=lambda channel: pir_event.set(), bouncetime=200)
+    pir_edge_detect = True
+except RuntimeError as e:
+    print(f"Détection de fronts indisponible ({e}), scrutation du PIR")
+    pir_edge_detect = False
+
 # === Initialisation de la caméra et du système d'encodage ===
 picam2 = Picamera2()
-picam2.configure(picam2.create_video_configuration(main={"size": (1280, 720), "format": "RGB888"}))
+picam2.configure(picam2.create_video_configuration(main={"size": FRAME_SIZE, "format": "RGB888"}))
 encoder = H264Encoder()
 picam2.start()
 
-# === Chargement du modèle IA YOLOv8 léger ===
-model = YOLO("yolov8n.pt")
+# === Capture d'une image ===
+# Avec Picamera2, "RGB888" fournit déjà les pixels dans l'ordre [B, G, R]
+# attendu par OpenCV : aucune conversion n'est nécessaire.
+def capture_frame():
+    return picam2.capture_array()
 
 # === Fonction pour démarrer l'enregistrement ===
 def start_recording(target_detect, timestamp):
+    global _prev_gray, _active_recording
     set_recording_status(True)
-    filename = f"{timestamp}_{target_detect}.h264"
+    _prev_gray = None  # Pas de comparaison avec la dernière image du clip précédent
+    filename = f"{timestamp}_{target_detect}.mp4"
     path = os.path.join(daily_video_dir, filename)
     print(f"Démarrage de l'enregistrement : {path}")
-    picam2.start_recording(encoder, path)
+    # La caméra tourne déjà : on ne démarre que l'encodeur.
+    # Le flux H.264 est multiplexé directement en MP4, sans conversion ffmpeg,
+    # dans un fichier .part que l'interface ignore tant que l'index MP4
+    # (écrit à la fin) n'est pas en place.
+    picam2.start_encoder(encoder, PyavOutput(path + ".part", format="mp4"))
+    _active_recording = path
     return path
 
+# === Finalisation du clip en cours ===
+def finish_clip():
+    global _active_recording
+    # stop_recording() arrêterait aussi la caméra (et réinitialiserait
+    # l'exposition) : seul l'encodeur est coupé
+    picam2.stop_encoder()
+    os.replace(_active_recording + ".part", _active_recording)
+    _active_recording = None
+
 # === Fonction pour arrêter l'enregistrement ===
 def stop_recording(path, label=None, confidence=None, timestamp=None):
-    path = path.replace(".h264", ".mp4")
-    picam2.stop_recording()
+    finish_clip()
     log_detection(label=label, confidence=confidence, video_path=path, timestamp=timestamp)
     set_recording_status(False)
 
 # === Fonction de détection IA ===
 def recognize_targets(frame):
-    results = model(frame, verbose=False)
+    # Réduction préalable (INTER_AREA) en gardant le ratio : YOLO n'a plus
+    # qu'à compléter l'image en DETECT_SIZE x DETECT_SIZE
+    height, width = frame.shape[:2]
+    small = cv2.resize(frame, (DETECT_SIZE, DETECT_SIZE * height // width), interpolation=cv2.INTER_AREA)
+    with _model_lock:
+        results = model(small, imgsz=DETECT_SIZE, verbose=False)
     boxes = results[0].boxes
     names = results[0].names
 
@@ -72,25 +139,63 @@ def recognize_targets(frame):
             return label, confidence
     return None, None
     
+# === Analyse IA en continu dans un thread dédié ===
+def detection_worker():
+    while True:
+        frame = frame_q.get()
+        try:
+            label, _ = recognize_targets(frame)
+        except Exception as e:
+            # Le thread ne doit pas mourir en silence : sans résultat, on
+            # considère qu'il n'y a plus de présence
+            print(f"Erreur lors de l'analyse IA : {e}")
+            label = None
+        with _result_lock:
+            result["label"] = label
+
+def submit_frame(frame):
+    # Remplace l'image en attente si le thread n'a pas encore pu la traiter
+    try:
+        frame_q.put_nowait(frame)
+    except queue.Full:
+        try:
+            frame_q.get_nowait()
+        except queue.Empty:
+            pass
+        frame_q.put_nowait(frame)
+
+def reset_detection(label):
+    try:
+        frame_q.get_nowait()
+    except queue.Empty:
+        pass
+    with _result_lock:
+        result["label"] = label
+
+# === Détection de mouvement rapide depuis la dernière analyse IA ===
+def needs_detection(frame, now):
+    # La comparaison se fait avec la dernière image réellement analysée, pour
+    # qu'un mouvement lent finisse par dépasser le seuil ; une analyse est de
+    # toute façon forcée toutes les FORCE_DETECT_INTERVAL secondes.
+    global _prev_gray, _last_detect_time
+    small = cv2.resize(frame, (160, 90), interpolation=cv2.INTER_AREA)
+    gray = cv2.cvtColor(small, cv2.COLOR_BGR2GRAY)
+    if _prev_gray is not None and now - _last_detect_time < FORCE_DETECT_INTERVAL \
+            and cv2.absdiff(gray, _prev_gray).mean() < MOTION_THRESHOLD:
+        return False
+    _prev_gray = gray
+    _last_detect_time = now
+    return True
+
 # === Fonction pour enregistrer les détections dans un fichier CSV ===
 def log_detection(timestamp, label, confidence, video_path=None):
-    file_exists = os.path.isfile("logs/detections.csv")
-    with open("logs/detections.csv", mode="a", newline="") as file:
-        writer = csv.writer(file)
-        if not file_exists or os.stat("logs/detections.csv").st_size == 0:
-            writer.writerow(["timestamp", "label", "confidence", "video_path"])
-        writer.writerow([timestamp, label, confidence, video_path])
+    global _header_written
+    if not _header_written:
+        _log_writer.writerow(["timestamp", "label", "confidence", "video_path"])
+        _header_written = True
+    _log_writer.writerow([timestamp, label, confidence, video_path])
+    _log_f.flush()
         
-# === Fonction pour convertir le fichier H264 en MP4 ===
-def wrap_h264_to_mp4(h264_path):
-    mp4_path = h264_path.replace(".h264", ".mp4")
-    subprocess.run([
-        "ffmpeg", "-y", "-framerate", "25",
-        "-i", h264_path,
-        "-c", "copy", mp4_path
-    ])
-    return mp4_path
-
 # === Gestion du statut d'enregistrement ===
 def set_recording_status(active: bool):
     if active:
@@ -98,29 +203,49 @@ def set_recording_status(active: bool):
     elif os.path.exists(STATUS_RECORDING_FILE):
         os.remove(STATUS_RECORDING_FILE)
         
+# === Attente d'un déclenchement du PIR ===
+def wait_for_pir(timeout):
+    # L'événement n'est effacé que s'il a été reçu, pour ne perdre aucun front
+    if pir_edge_detect:
+        if pir_event.wait(timeout=timeout):
+            pir_event.clear()
+            return True
+        return False
+    # Repli sans détection de fronts : lecture de la broche toutes les 100 ms
+    deadline = time.monotonic() + timeout
+    while True:
+        if pir_event.is_set() or GPIO.input(PIR_GPIO) == GPIO.HIGH:
+            pir_event.clear()
+            return True
+        remaining = deadline - time.monotonic()
+        if remaining <= 0:
+            return False
+        time.sleep(min(0.1, remaining))
+
 # === Fonction pour vérifier si c'est un cadre de nuit ===        
 def is_night_frame(frame, threshold=40):
-    gray = cv2.cvtColor(frame, cv2.COLOR_BGR2GRAY)
-    brightness = np.mean(gray)
+    # Moyenne B+G+R sur un pixel sur 16 dans chaque direction (vue 80x45) :
+    # suffisant pour distinguer le jour de la nuit, sans conversion en gris
+    brightness = frame[::16, ::16].mean()
     return brightness < threshold
 
 # === Prétraitement des images pour améliorer la détection de nuit ===
 def preprocess_frame(frame):
     if is_night_frame(frame):
-        gray = cv2.cvtColor(frame, cv2.COLOR_BGR2GRAY)
-        clahe = cv2.createCLAHE(clipLimit=2.0, tileGridSize=(8,8))
-        enhanced = clahe.apply(gray)
+        gray = cv2.cvtColor(frame, cv2.COLOR_BGR2GRAY, dst=_gray_buf)
+        enhanced = _CLAHE.apply(gray)
         return cv2.cvtColor(enhanced, cv2.COLOR_GRAY2BGR)
     else:
         return frame  # image de jour → pas de traitement
 
+threading.Thread(target=detection_worker, daemon=True).start()
+
 try:
     print("Système actif et prêt")
     while True:
-        now = time.time()
-        if now - last_check > check_interval:
-            frame_check = picam2.capture_array()
-            frame_check = cv2.cvtColor(frame_check, cv2.COLOR_BGRA2BGR)
+        now = time.monotonic()
+        if now - last_check >= check_interval:
+            frame_check = capture_frame()
             is_night_mode = is_night_frame(frame_check)
             last_check = now
             if is_night_mode:
@@ -128,46 +253,67 @@ try:
             else:
                 GPIO.output(IR_CUT_GPIO, GPIO.LOW)
 
-        if GPIO.input(PIR_GPIO) == GPIO.HIGH:
+        # Attente du PIR, au plus jusqu'à la prochaine vérification jour/nuit
+        if wait_for_pir(max(0, last_check + check_interval - time.monotonic())):
             print("Détection thermique : analyse IA en cours")
-            frame = picam2.capture_array()
-            frame = cv2.cvtColor(frame, cv2.COLOR_BGRA2BGR)
+            frame = capture_frame()
             if is_night_mode:
                 frame = preprocess_frame(frame)
 
             label, confidence = recognize_targets(frame)
+            if not label and GPIO.input(PIR_GPIO) == GPIO.HIGH:
+                # Le sujet n'est peut-être pas encore dans le champ : nouvel
+                # essai tant que le PIR reste actif, au rythme de l'ancienne scrutation
+                time.sleep(0.1)
+                pir_event.set()
             if label:
                 timestamp = datetime.now().strftime("%Y-%m-%d_%H-%M-%S")
                 video_path = start_recording(label, timestamp)
-                start_time = time.time()
-                last_presence_time = time.time()
+                start_time = time.monotonic()
+                last_presence_time = start_time
+                next_deadline = start_time
+                reset_detection(label)
 
-                while time.time() - start_time < MAX_DURATION:
-                    frame = picam2.capture_array()
-                    frame = cv2.cvtColor(frame, cv2.COLOR_BGRA2BGR)
+                while True:
+                    t_now = time.monotonic()
+                    if t_now - start_time >= MAX_DURATION:
+                        break
+                    frame = capture_frame()
                     if is_night_mode:
                         frame = preprocess_frame(frame)
 
-                    label, conf = recognize_targets(frame)
+                    # Image quasi identique : on garde le dernier résultat sans relancer YOLO.
+                    # L'analyse se fait dans detection_worker, la boucle ne l'attend pas.
+                    if needs_detection(frame, t_now):
+                        submit_frame(frame)
+                    with _result_lock:
+                        label = result["label"]
                     if label:
-                        last_presence_time = time.time()
-                    elif time.time() - last_presence_time > NO_PRESENCE_TIMEOUT:
+                        last_presence_time = t_now
+                    elif t_now - last_presence_time > NO_PRESENCE_TIMEOUT:
                         print("Aucune présence prolongée, arrêt anticipé")
                         break
 
-                    time.sleep(0.05)
+                    # Sommeil calé sur une échéance fixe pour éviter la dérive ;
+                    # en cas de retard on repart de maintenant plutôt que de rattraper
+                    next_deadline = max(next_deadline + RECORD_LOOP_PERIOD, t_now)
+                    time.sleep(max(0, next_deadline - time.monotonic()))
 
                 stop_recording(video_path, label, confidence, timestamp)
-                mp4_path = wrap_h264_to_mp4(video_path)
-                os.remove(video_path)
-                print(f"Vidéo convertie et sauvegardée : {mp4_path}")
+                print(f"Vidéo sauvegardée : {video_path}")
                 time.sleep(2)
-
-        time.sleep(0.1)
+                # Pas de nouveau front si le PIR est resté actif : on relance l'analyse
+                if GPIO.input(PIR_GPIO) == GPIO.HIGH:
+                    pir_event.set()
     
 except KeyboardInterrupt:
     print("Arrêt manuel demandé")
 
 finally:
+    if _active_recording:
+        # Arrêt pendant un clip : on ferme proprement le MP4 pour qu'il reste lisible
+        finish_clip()
+        set_recording_status(False)
+    _log_f.close()
     picam2.stop()
     GPIO.cleanup()